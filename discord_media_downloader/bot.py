@@ -1,14 +1,19 @@
 import asyncio
-import json
 import logging
 import os
 import random
 import re
+import threading
 from datetime import datetime, timezone
-from typing import Dict, Optional, Set
+from functools import lru_cache
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional, Sequence, Set, TypeVar
+from urllib.parse import urlsplit, urlunsplit
 
+import aiofiles
+import aiohttp
 import discord
-import requests
+import orjson
+import xxhash
 from dotenv import load_dotenv
 
 # Set up logging
@@ -23,6 +28,7 @@ logger.addHandler(file_handler)
 
 # Console handler for logging
 console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
 console_formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
 console_handler.setFormatter(console_formatter)
 logger.addHandler(console_handler)
@@ -36,34 +42,95 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN", "your_actual_bot_token_here")
 # Regular expressions for media detection
 IMAGE_REGEX = r"https:\/\/cdn\.discordapp\.com\/attachments\/\d*\/\d*\/([a-z0-9\_\-\.]*)\.(jpg|jpeg|png|gif|bmp|webp)(\?.*)?$"
 VIDEO_REGEX = r"https:\/\/cdn\.discordapp\.com\/attachments\/\d*\/\d*\/([a-z0-9\_\-\.]*)\.(mp4|avi|mov|mkv|webm|flv)(\?.*)?$"
+_IMAGE_RE = re.compile(IMAGE_REGEX)
+_VIDEO_RE = re.compile(VIDEO_REGEX)
+
+# Extension sets for classifying attachments whose extension is already parsed
+_IMAGE_EXTS = frozenset({"jpg", "jpeg", "png", "gif", "bmp", "webp"})
+_VIDEO_EXTS = frozenset({"mp4", "avi", "mov", "mkv", "webm", "flv"})
+_EXT_RE = re.compile(r"\.([a-z0-9]+)(?:\?|$)", re.IGNORECASE)
+
+# Scan command argument: a mode flag or a message count
+_SCAN_ARG_RE = re.compile(r"^(?:--(all|new)|(\d+))$")
+
+# Download options for each combination of found media (bit 0: images, 1: videos, 2: others);
+# "Tất cả" is offered whenever more than one category is present
+_MEDIA_OPTION_NAMES = ("Hình ảnh", "Video", "Media khác")
+_DOWNLOAD_OPTIONS = {
+    mask: tuple(name for bit, name in enumerate(_MEDIA_OPTION_NAMES) if mask & (1 << bit))
+    + (("Tất cả",) if bin(mask).count("1") > 1 else ())
+    for mask in range(8)
+}
+
+# Embed colors for scan reports
+REPORT_COLORS = (0xFF0000, 0xFFEE00, 0x40FF00, 0x00BBFF, 0xFF00BB)
 
 # Files to store data
 HISTORY_FILE = "scan_history.json"
 RECOVERY_FILE = "scan_recovery.json"
 
+# Download settings
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MAX_CONCURRENT_DOWNLOADS = 8
+DOWNLOAD_PROGRESS_INTERVAL = 10  # Files between progress updates
+
+# Seconds between background flushes of scan progress
+RECOVERY_FLUSH_INTERVAL = 2
+
+# Number of messages analyzed per batch while streaming channel history
+SCAN_BATCH_SIZE = 64
+
+T = TypeVar("T")
+
 
 def is_image(content: str) -> bool:
     """Check if the given URL is an image."""
-    return bool(re.match(IMAGE_REGEX, str(content).lower()))
+    return _IMAGE_RE.match(content.lower()) is not None
 
 
 def is_video(content: str) -> bool:
     """Check if the given URL is a video."""
-    return bool(re.match(VIDEO_REGEX, str(content).lower()))
+    return _VIDEO_RE.match(content.lower()) is not None
 
 
+def canonical_url(url: str) -> str:
+    """Strip the query and fragment so rotated CDN signatures map to the same URL."""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+
+
+def url_fingerprint(url: str) -> int:
+    """64-bit hash of the canonical URL, used as the scan history key."""
+    return xxhash.xxh64_intdigest(canonical_url(url).encode())
+
+
+class _SafeCharTable(dict):
+    """str.translate table for safe_string, filled lazily per code point."""
+
+    def __missing__(self, codepoint: int) -> Optional[str]:
+        char = chr(codepoint)
+        if char.isalnum() or char in "-_.":
+            value: Optional[str] = char
+        elif char.isspace():
+            value = "_"
+        else:
+            value = None  # Drop the character
+        self[codepoint] = value
+        return value
+
+
+_SAFE_CHAR_TABLE = _SafeCharTable()
+_UNDERSCORE_RE = re.compile(r"_+")
+
+
+@lru_cache(maxsize=4096)
 def safe_string(text: str) -> str:
     """Convert text to a safe filename string."""
-    result_text = ""
-    for char in str(text):
-        if char.isalnum() or char in ["-", "_", "."]:
-            result_text += char
-        elif char.isspace():
-            result_text += "_"
+    result_text = str(text).translate(_SAFE_CHAR_TABLE)
     
     # Remove consecutive underscores and limit length
-    result_text = re.sub(r"_+", "_", result_text).strip("_")
-    return result_text[:50] if len(result_text) > 50 else result_text
+    result_text = _UNDERSCORE_RE.sub("_", result_text).strip("_")
+    return result_text[:50]
 
 
 def format_date(datetime_instance: datetime) -> str:
@@ -71,54 +138,87 @@ def format_date(datetime_instance: datetime) -> str:
     return datetime_instance.strftime("%Y-%m-%d_%H-%M-%S")
 
 
+@lru_cache(maxsize=128)
 def format_display_date(datetime_instance: datetime) -> str:
     """Format datetime for display."""
     return datetime_instance.strftime("%d/%m/%Y %H:%M:%S")
 
 
+@lru_cache(maxsize=128)
+def _sanitize_folder(server_name: str, channel_name: str) -> str:
+    """Build the safe server/channel prefix of a download folder name."""
+    return f"{safe_string(server_name)}_{safe_string(channel_name)}"
+
+
 def create_folder(server_name: str, channel_name: str) -> str:
     """Create a folder for downloads and return the path."""
-    current_path = os.getcwd()
-    downloads_folder = os.path.join(current_path, "downloads")
+    downloads_folder = os.path.join(os.getcwd(), "downloads")
     
-    # Create downloads folder if it doesn't exist
-    if not os.path.exists(downloads_folder):
-        os.makedirs(downloads_folder)
-    
-    server_name = safe_string(server_name)
-    channel_name = safe_string(channel_name)
     datetime_str = format_date(datetime.now())
-    folder_name = f"{server_name}_{channel_name}_{datetime_str}"
+    folder_name = f"{_sanitize_folder(server_name, channel_name)}_{datetime_str}"
 
     path = os.path.join(downloads_folder, folder_name)
 
-    if not os.path.exists(path):
-        os.makedirs(path)
-        logger.info(f"[+] Created folder: {path}")
+    # Creates the downloads folder too; exist_ok avoids the exists/makedirs race
+    os.makedirs(path, exist_ok=True)
+    logger.info(f"[+] Created folder: {path}")
     
     return path
 
 
-async def download_media(url: str, folder: str, file_name: str) -> bool:
+async def download_media(session: aiohttp.ClientSession, url: str, folder: str, file_name: str) -> bool:
     """Download media file from URL."""
     try:
         logger.info(f"[*] Downloading {url} as {file_name}")
         path = os.path.join(folder, file_name)
         
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        
-        with open(path, "wb") as file:
-            file.write(response.content)
+        # Limit connect/read stalls only, so large files can take as long as they need
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+        async with session.get(url, timeout=timeout) as response:
+            response.raise_for_status()
+            
+            async with aiofiles.open(path, "wb") as file:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await file.write(chunk)
         
         logger.info(f"[+] Download successful: {file_name}")
         return True
         
     except Exception as e:
         logger.error(f"[-] Download failed for {file_name}: {str(e)}")
+        # Don't leave a truncated file behind from a partially streamed download
+        try:
+            os.remove(os.path.join(folder, file_name))
+        except OSError:
+            pass
         return False
 
 
+def write_json_atomic(path: str, data: Dict, fsync: bool = False):
+    """Serialize data to JSON and atomically replace the file at path."""
+    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+async def abatch_iterate(size: int, iterable: AsyncIterable[T]) -> AsyncIterator[List[T]]:
+    """Group items from an async iterable into lists of at most size items."""
+    batch: List[T] = []
+    async for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@lru_cache(maxsize=512)
 def convert_byte_to_mb(byte: int) -> float:
     """Convert bytes to megabytes."""
     return round(byte / 1024 / 1024, 3)
@@ -129,26 +229,44 @@ class ScanRecovery:
     
     def __init__(self):
         self.recovery_data = self.load_recovery()
+        self._dirty = False  # Progress changed since last save
+        self._save_lock = threading.Lock()  # Saves may run in a worker thread
     
     def load_recovery(self) -> Dict:
         """Load recovery data from file."""
         try:
-            if os.path.exists(RECOVERY_FILE):
-                with open(RECOVERY_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except Exception as e:
+            with open(RECOVERY_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            pass
+        except (OSError, orjson.JSONDecodeError) as e:
             logger.error(f"[-] Error loading recovery data: {e}")
         return {}
     
-    def save_recovery(self):
-        """Save recovery data to file."""
-        try:
-            with open(RECOVERY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.recovery_data, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            logger.error(f"[-] Error saving recovery data: {e}")
+    def save_recovery(self, fsync: bool = False):
+        """Save recovery data to file (blocking; called via asyncio.to_thread while the bot runs)."""
+        with self._save_lock:
+            # Cleared before serializing so updates made during the write mark it dirty again
+            self._dirty = False
+            try:
+                write_json_atomic(RECOVERY_FILE, self.recovery_data, fsync=fsync)
+            except Exception as e:
+                self._dirty = True
+                logger.error(f"[-] Error saving recovery data: {e}")
+    
+    def flush(self):
+        """Save recovery data if there are unsaved progress updates."""
+        if self._dirty:
+            self.save_recovery()
+    
+    async def _periodic_flush(self):
+        """Periodically save buffered progress updates without blocking the event loop."""
+        while True:
+            await asyncio.sleep(RECOVERY_FLUSH_INTERVAL)
+            if self._dirty:
+                await asyncio.to_thread(self.save_recovery)
     
-    def start_scan_session(self, channel_id: int, scan_type: str, start_time: datetime, scan_params: Dict):
+    async def start_scan_session(self, channel_id: int, scan_type: str, start_time: datetime, scan_params: Dict):
         """Start a new scan session."""
         channel_key = str(channel_id)
         self.recovery_data[channel_key] = {
@@ -160,7 +278,7 @@ class ScanRecovery:
             'processed_count': 0,
             'found_media': 0
         }
-        self.save_recovery()
+        await asyncio.to_thread(self.save_recovery)
         logger.info(f"[+] Started scan session for channel {channel_id}")
     
     def update_scan_progress(self, channel_id: int, message_id: int, processed_count: int, found_media: int):
@@ -170,14 +288,14 @@ class ScanRecovery:
             self.recovery_data[channel_key]['last_processed_message'] = message_id
             self.recovery_data[channel_key]['processed_count'] = processed_count
             self.recovery_data[channel_key]['found_media'] = found_media
-            self.save_recovery()
+            self._dirty = True
     
-    def complete_scan_session(self, channel_id: int):
+    async def complete_scan_session(self, channel_id: int):
         """Mark scan session as completed."""
         channel_key = str(channel_id)
         if channel_key in self.recovery_data:
             self.recovery_data[channel_key]['status'] = 'completed'
-            self.save_recovery()
+            await asyncio.to_thread(self.save_recovery, True)
             logger.info(f"[+] Completed scan session for channel {channel_id}")
     
     def get_interrupted_scan(self, channel_id: int) -> Optional[Dict]:
@@ -187,12 +305,12 @@ class ScanRecovery:
             return self.recovery_data[channel_key]
         return None
     
-    def clear_recovery_data(self, channel_id: int):
+    async def clear_recovery_data(self, channel_id: int):
         """Clear recovery data for a channel."""
         channel_key = str(channel_id)
         if channel_key in self.recovery_data:
             del self.recovery_data[channel_key]
-            self.save_recovery()
+            await asyncio.to_thread(self.save_recovery)
 
 
 class ScanHistory:
@@ -200,31 +318,39 @@ class ScanHistory:
     
     def __init__(self):
         self.history = self.load_history()
+        # In-memory URL fingerprint sets per channel; lists are only materialized on save.
+        # Older history files stored raw URLs, which are fingerprinted on load.
+        self._url_sets: Dict[str, Set[int]] = {
+            channel_key: {
+                url if isinstance(url, int) else url_fingerprint(url)
+                for url in data.get('scanned_urls', [])
+            }
+            for channel_key, data in self.history.items()
+        }
     
     def load_history(self) -> Dict:
         """Load scan history from file."""
         try:
-            if os.path.exists(HISTORY_FILE):
-                with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except Exception as e:
+            with open(HISTORY_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            pass
+        except (OSError, orjson.JSONDecodeError) as e:
             logger.error(f"[-] Error loading history: {e}")
         return {}
     
     def save_history(self):
         """Save scan history to file."""
+        for channel_key, urls in self._url_sets.items():
+            self.history[channel_key]['scanned_urls'] = list(urls)
         try:
-            with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.history, f, indent=2, ensure_ascii=False)
+            write_json_atomic(HISTORY_FILE, self.history)
         except Exception as e:
             logger.error(f"[-] Error saving history: {e}")
     
-    def get_scanned_urls(self, channel_id: int) -> Set[str]:
-        """Get set of already scanned URLs for a channel."""
-        channel_key = str(channel_id)
-        if channel_key in self.history:
-            return set(self.history[channel_key].get('scanned_urls', []))
-        return set()
+    def get_scanned_urls(self, channel_id: int) -> Set[int]:
+        """Get set of already scanned URL fingerprints for a channel (do not mutate)."""
+        return self._url_sets.get(str(channel_id), set())
     
     def get_last_scan_time(self, channel_id: int) -> Optional[datetime]:
         """Get the last scan time for a channel."""
@@ -232,12 +358,12 @@ class ScanHistory:
         if channel_key in self.history and self.history[channel_key].get('last_scan'):
             try:
                 return datetime.fromisoformat(self.history[channel_key]['last_scan'])
-            except:
+            except ValueError:
                 return None
         return None
     
-    def add_scanned_urls(self, channel_id: int, urls: Set[str]):
-        """Add scanned URLs to history for a channel."""
+    def add_scanned_urls(self, channel_id: int, urls: Set[int]):
+        """Add scanned URL fingerprints (see url_fingerprint) to history for a channel."""
         channel_key = str(channel_id)
         if channel_key not in self.history:
             self.history[channel_key] = {
@@ -247,9 +373,7 @@ class ScanHistory:
             }
         
         # Add new URLs to existing ones
-        existing_urls = set(self.history[channel_key]['scanned_urls'])
-        existing_urls.update(urls)
-        self.history[channel_key]['scanned_urls'] = list(existing_urls)
+        self._url_sets.setdefault(channel_key, set()).update(urls)
         self.history[channel_key]['last_scan'] = datetime.now().isoformat()
         self.history[channel_key]['total_scans'] += 1
         
@@ -260,7 +384,7 @@ class ScanHistory:
         channel_key = str(channel_id)
         if channel_key in self.history:
             return {
-                'total_scanned': len(self.history[channel_key]['scanned_urls']),
+                'total_scanned': len(self._url_sets.get(channel_key, ())),
                 'last_scan': self.history[channel_key]['last_scan'],
                 'total_scans': self.history[channel_key]['total_scans']
             }
@@ -271,16 +395,88 @@ class ScanHistory:
         channel_key = str(channel_id)
         if channel_key in self.history:
             del self.history[channel_key]
+            self._url_sets.pop(channel_key, None)
             self.save_history()
 
 
+class DownloadButton(discord.ui.Button["DownloadView"]):
+    """Button that selects its label as the download option."""
+    
+    async def callback(self, interaction: discord.Interaction):
+        if self.view is None:
+            return
+        logger.info(f"[+] Received download selection: {self.label}")
+        self.view.selection = self.label
+        await interaction.response.defer()
+        self.view.stop()
+
+
+class DownloadView(discord.ui.View):
+    """Buttons for choosing which media to download."""
+    
+    def __init__(self, options: Sequence[str], author_id: int, timeout: float = 60.0):
+        super().__init__(timeout=timeout)
+        self.author_id = author_id
+        self.selection: Optional[str] = None
+        
+        for option in options:
+            self.add_item(DownloadButton(label=option, style=discord.ButtonStyle.primary))
+    
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        """Only the user who ran the scan can pick a download option."""
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("❌ Chỉ người yêu cầu quét mới có thể chọn.", ephemeral=True)
+            return False
+        return True
+
+
 class MyClient(discord.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.prefix = ">"
-        self.active_scans: Dict[int, bool] = {}  # Track active scans per channel
+        self._channel_locks: Dict[int, asyncio.Lock] = {}  # Scan lock per channel
         self.scan_history = ScanHistory()  # History manager
         self.scan_recovery = ScanRecovery()  # Recovery manager
+        self._http: Optional[aiohttp.ClientSession] = None  # Shared HTTP session for downloads
+        self._recovery_flush_task: Optional[asyncio.Task] = None  # Background recovery flusher
+        # Commands that don't need a permission check: name -> handler(message)
+        self._public_commands = {
+            "ping": self.handle_ping,
+            "help": self.handle_help,
+        }
+        # Command name -> handler(message, is_admin)
+        self._commands = {
+            "check_recovery": self.handle_check_recovery,
+            "resume_scan": self.handle_resume_scan,
+            "clear_recovery": self.handle_clear_recovery,
+            "history": self.handle_history,
+            "clear_history": self.handle_clear_history,
+        }
+
+    async def setup_hook(self):
+        self._http = aiohttp.ClientSession()
+        self._recovery_flush_task = asyncio.create_task(self.scan_recovery._periodic_flush())
+
+    async def close(self):
+        if self._recovery_flush_task is not None:
+            self._recovery_flush_task.cancel()
+        await asyncio.to_thread(self.scan_recovery.flush)
+        if self._http is not None:
+            await self._http.close()
+        await super().close()
+
+    def _get_channel_lock(self, channel_id: int) -> asyncio.Lock:
+        """Get the scan lock for a channel, creating it on first use."""
+        lock = self._channel_locks.get(channel_id)
+        if lock is None:
+            lock = self._channel_locks[channel_id] = asyncio.Lock()
+        return lock
+
+    def _discard_channel_lock(self, channel_id: int):
+        """Drop an idle channel lock so the map doesn't grow with every channel ever scanned."""
+        lock = self._channel_locks.get(channel_id)
+        if lock is not None and not lock.locked():
+            del self._channel_locks[channel_id]
 
     async def on_ready(self):
         logger.info(f"[*] {self.user.name} is ALIVE!")
@@ -298,39 +494,23 @@ class MyClient(discord.Client):
             return
             
         command = message.content.removeprefix(self.prefix).strip()
-        is_admin = message.author.guild_permissions.administrator if message.guild else True
 
         logger.info(f"[*] {format_date(datetime.now())}: {message.author}: {command}")
 
-        # Ping command
-        if command == "ping":
-            await self.handle_ping(message)
-            
-        # Scan command
+        # Public commands skip the guild permission lookup
+        public_handler = self._public_commands.get(command)
+        if public_handler:
+            await public_handler(message)
+            return
+
+        is_admin = message.author.guild_permissions.administrator if message.guild else True
+
+        # Parameterized scan command is matched by prefix, everything else exactly
+        handler = self._commands.get(command)
+        if handler:
+            await handler(message, is_admin)
         elif command.startswith("scan"):
             await self.handle_scan(message, command, is_admin)
-        
-        # Recovery commands
-        elif command == "check_recovery":
-            await self.handle_check_recovery(message, is_admin)
-        
-        elif command == "resume_scan":
-            await self.handle_resume_scan(message, is_admin)
-        
-        elif command == "clear_recovery":
-            await self.handle_clear_recovery(message, is_admin)
-        
-        # History command
-        elif command == "history":
-            await self.handle_history(message, is_admin)
-        
-        # Clear history command
-        elif command == "clear_history":
-            await self.handle_clear_history(message, is_admin)
-            
-        # Help command
-        elif command == "help":
-            await self.handle_help(message)
 
     async def handle_ping(self, message):
         """Handle ping command."""
@@ -432,12 +612,13 @@ class MyClient(discord.Client):
             return
 
         # Check if there's already an active scan in this channel
-        if self.active_scans.get(message.channel.id, False):
+        lock = self._get_channel_lock(message.channel.id)
+        if lock.locked():
             await message.reply("⚠️ Đã có một quét đang hoạt động trong kênh này.", delete_after=10)
             return
 
-        # Mark channel as having active scan
-        self.active_scans[message.channel.id] = True
+        # Mark channel as having active scan (uncontended, so this doesn't yield)
+        await lock.acquire()
 
         try:
             await message.channel.send("🔄 Đang khôi phục và tiếp tục quá trình quét...")
@@ -453,8 +634,9 @@ class MyClient(discord.Client):
             logger.error(f"[-] Error in resume scan: {str(e)}")
             await message.channel.send(f"❌ Đã xảy ra lỗi khi khôi phục quét: {str(e)}", delete_after=10)
         finally:
-            # Remove active scan flag
-            self.active_scans[message.channel.id] = False
+            # Release the scan lock
+            lock.release()
+            self._discard_channel_lock(message.channel.id)
 
     async def handle_clear_recovery(self, message, is_admin):
         """Handle clear recovery command."""
@@ -462,7 +644,7 @@ class MyClient(discord.Client):
             await message.reply("❌ Đây là lệnh chỉ dành cho admin.", delete_after=10)
             return
         
-        self.scan_recovery.clear_recovery_data(message.channel.id)
+        await self.scan_recovery.clear_recovery_data(message.channel.id)
         await message.channel.send("✅ Đã xóa dữ liệu khôi phục của kênh này.", delete_after=10)
 
     async def resume_scanning_process(self, message, recovery_data, last_message_id):
@@ -479,37 +661,33 @@ class MyClient(discord.Client):
             # Continue time-based scan
             since_time = datetime.fromisoformat(scan_params['since_time'])
             limit = scan_params.get('limit')
-            message_history = await self.get_messages_since_time(message.channel, since_time, limit, last_message_id)
+            message_history = self.get_messages_since_time(message.channel, since_time, limit, last_message_id)
         else:
             # Continue number-based scan
             remaining_limit = scan_params['limit'] - recovery_data['processed_count']
             if remaining_limit <= 0:
                 await message.channel.send("✅ Quá trình quét đã hoàn thành trước đó.")
-                self.scan_recovery.complete_scan_session(message.channel.id)
+                await self.scan_recovery.complete_scan_session(message.channel.id)
                 return
             
-            message_history = await self.get_messages_from_point(message.channel, last_message_id, remaining_limit)
-        
-        if not message_history:
-            await message.channel.send("✅ Không có tin nhắn mới nào để tiếp tục quét.")
-            self.scan_recovery.complete_scan_session(message.channel.id)
-            return
+            message_history = self.get_messages_from_point(message.channel, last_message_id, remaining_limit)
 
-        # Continue analyzing messages
+        # Continue analyzing messages as they are fetched
         scan_all = scan_params.get('scan_all', False)
-        images, videos, others, new_urls = await self.analyze_messages_with_recovery(
+        images, videos, others, new_urls, media_sizes, message_count = await self.analyze_messages_with_recovery(
             message_history, scanned_urls, scan_all, message.channel.id, recovery_data['processed_count']
         )
-
-        # Calculate sizes and send report
-        total_image_size, total_video_size, total_other_size = await self.calculate_media_sizes(
-            message_history, images, videos, others
-        )
+        total_image_size, total_video_size, total_other_size = media_sizes
+        
+        if not message_count:
+            await message.channel.send("✅ Không có tin nhắn mới nào để tiếp tục quét.")
+            await self.scan_recovery.complete_scan_session(message.channel.id)
+            return
 
         # Send report
         await self.send_resume_report(message, images, videos, others, 
                                     total_image_size, total_video_size, total_other_size, 
-                                    len(message_history), recovery_data)
+                                    message_count, recovery_data)
 
         # Handle download options if media found
         if images or videos or others:
@@ -522,139 +700,116 @@ class MyClient(discord.Client):
                 logger.info(f"[+] Added {len(new_urls)} new URLs to history")
 
         # Mark scan as completed
-        self.scan_recovery.complete_scan_session(message.channel.id)
+        await self.scan_recovery.complete_scan_session(message.channel.id)
         await message.channel.send("✅ Đã hoàn thành quá trình quét được khôi phục!", delete_after=10)
 
-    async def get_messages_from_point(self, channel, last_message_id, limit):
-        """Get messages continuing from a specific point."""
-        messages = []
-        found_start = last_message_id is None  # If no last message, start from beginning
+    def get_messages_from_point(self, channel, last_message_id, limit) -> AsyncIterator[discord.Message]:
+        """Iterate messages continuing from a specific point."""
+        # Scans walk history newest-first, so resuming continues with older messages
+        before = discord.Object(id=last_message_id) if last_message_id else None
+        return channel.history(limit=limit, before=before)
+
+    def get_messages_since_time(self, channel, since_time: datetime, limit: Optional[int] = None, last_message_id: Optional[int] = None) -> AsyncIterator[discord.Message]:
+        """Iterate messages from channel since a specific time, optionally starting from a specific message."""
+        before = discord.Object(id=last_message_id) if last_message_id else None
+        # Stored scan times are naive local time; make the boundary aware once up front
+        if since_time.tzinfo is None:
+            since_time = since_time.astimezone()
         
-        async for message in channel.history(limit=limit * 2):  # Get more to find starting point
-            if not found_start:
-                if message.id == last_message_id:
-                    found_start = True
-                continue
-            
-            messages.append(message)
-            if len(messages) >= limit:
-                break
-        
-        return messages
-
-    async def get_messages_since_time(self, channel, since_time: datetime, limit: Optional[int] = None, last_message_id: Optional[int] = None):
-        """Get messages from channel since a specific time, optionally starting from a specific message."""
-        messages = []
-        count = 0
-        max_messages = limit or 500
-        found_start = last_message_id is None
-        
-        async for message in channel.history(limit=max_messages * 2):
-            if not found_start:
-                if message.id == last_message_id:
-                    found_start = True
-                continue
-            
-            # Convert message timestamp to naive datetime for comparison
-            message_time = message.created_at.replace(tzinfo=None)
-            since_time_naive = since_time.replace(tzinfo=None) if since_time.tzinfo else since_time
-            
-            if message_time <= since_time_naive:
-                break
-                
-            messages.append(message)
-            count += 1
-            
-            if limit and count >= limit:
-                break
-        
-        logger.info(f"[+] Found {len(messages)} messages to continue scanning")
-        return messages
-
-    async def analyze_messages_with_recovery(self, message_history, scanned_urls: Set[str], scan_all: bool, channel_id: int, start_counter: int):
-        """Analyze messages with recovery tracking."""
-        images = {}
-        videos = {}
-        others = {}
-        new_urls = set()
-        
-        counter = start_counter + 1
-        processed_count = start_counter
-        found_media = 0
-        
-        for message in message_history:
-            processed_count += 1
-            
+        # Let Discord filter by time; keep newest-first order like a regular scan
+        return channel.history(limit=limit or 500, before=before, after=since_time, oldest_first=False)
+
+    def _analyze_batch(self, batch: List[discord.Message], scanned_urls: Set[int], scan_all: bool, counter: int,
+                       media: Dict[str, tuple], sizes: Dict[str, int], new_url_keys: List[int]) -> int:
+        """Categorize attachments of one batch into the given accumulators and return the next counter.
+
+        Pure CPU work on already fetched messages, so it runs in a worker thread.
+        """
+        for message in batch:
             if message.attachments and not message.author.bot:
+                # Author and timestamp are the same for every attachment of a message;
+                # computed on the first new attachment so fully scanned messages skip them
+                author = None
+                created_at = None
+                
                 for attachment in message.attachments:
-                    attachment_url = str(attachment.url)
+                    url = attachment.url
+                    # History is keyed by a hash of the URL without its expiring signature
+                    url_key = url_fingerprint(url)
                     
                     # Skip if already scanned (unless scanning all)
-                    if not scan_all and attachment_url in scanned_urls:
-                        logger.debug(f"[*] Skipping already scanned: {attachment_url}")
+                    if not scan_all and url_key in scanned_urls:
+                        logger.debug("[*] Skipping already scanned: %s", url)
                         continue
                     
-                    logger.debug(f"[*] {counter} - {message.author.name}: {attachment}")
+                    if author is None:
+                        author = safe_string(str(message.author))
+                        created_at = format_date(message.created_at)
+                    
+                    logger.debug("[*] %d - %s: %s", counter, message.author.name, attachment)
 
-                    file_extension = attachment.url.rsplit(".", maxsplit=1)[-1]
-                    file_extension = file_extension.split("?")[0]  # Remove query parameters
+                    # Extension without query parameters
+                    extension_match = _EXT_RE.search(url)
+                    file_extension = extension_match.group(1) if extension_match else ""
                     
-                    author = safe_string(str(message.author))
-                    attachment_name = f"{counter:04d}_{format_date(message.created_at)}_{author}.{file_extension}"
-
-                    # Add to new URLs set
-                    new_urls.add(attachment_url)
-                    found_media += 1
-
-                    if is_image(attachment.url):
-                        logger.debug(f"[*] Image detected: {attachment.url}")
-                        images[attachment_url] = attachment_name
-                    elif is_video(attachment.url):
-                        logger.debug(f"[*] Video detected: {attachment.url}")
-                        videos[attachment_url] = attachment_name
+                    attachment_name = f"{counter:04d}_{created_at}_{author}.{file_extension}"
+
+                    # Add to new URLs
+                    new_url_keys.append(url_key)
+
+                    # Classify by extension; attachment URLs always come from the Discord CDN
+                    ext = file_extension.lower()
+                    if ext in _IMAGE_EXTS:
+                        category = "image"
+                    elif ext in _VIDEO_EXTS:
+                        category = "video"
                     else:
-                        logger.debug(f"[*] Other media detected: {attachment.url}")
-                        others[attachment_url] = attachment_name
+                        category = "other"
+                    logger.debug("[*] Detected %s: %s", category, url)
+                    
+                    urls, names = media[category]
+                    urls.append(url)
+                    names.append(attachment_name)
+                    sizes[category] += attachment.size
 
                     counter += 1
+        
+        return counter
+
+    async def analyze_messages_with_recovery(self, message_history: AsyncIterable[discord.Message], scanned_urls: Set[int], scan_all: bool, channel_id: int, start_counter: int):
+        """Analyze streamed messages in batches with recovery tracking and total attachment sizes per category."""
+        # Collected as parallel lists per category and turned into dicts once at the end
+        media: Dict[str, tuple] = {"image": ([], []), "video": ([], []), "other": ([], [])}
+        sizes = {"image": 0, "video": 0, "other": 0}
+        new_url_keys: List[int] = []
+        
+        counter = start_counter + 1
+        processed_count = start_counter
+        
+        async for batch in abatch_iterate(SCAN_BATCH_SIZE, message_history):
+            # Keep categorization off the event loop so heartbeats and other commands aren't starved
+            counter = await asyncio.to_thread(
+                self._analyze_batch, batch, scanned_urls, scan_all, counter, media, sizes, new_url_keys
+            )
+            processed_count += len(batch)
             
-            # Update recovery progress every 10 messages
-            if processed_count % 10 == 0:
-                self.scan_recovery.update_scan_progress(channel_id, message.id, processed_count, found_media)
+            # Update recovery progress after every batch
+            self.scan_recovery.update_scan_progress(channel_id, batch[-1].id, processed_count, len(new_url_keys))
 
-        # Final update
-        self.scan_recovery.update_scan_progress(channel_id, message_history[-1].id if message_history else None, processed_count, found_media)
+        images, videos, others = (dict(zip(*media[category])) for category in ("image", "video", "other"))
+        new_urls = set(new_url_keys)
 
         logger.info(f"[+] Resumed scan found: {len(images)} images, {len(videos)} videos, {len(others)} others (new: {len(new_urls)})")
-        return images, videos, others, new_urls
-
-    async def calculate_media_sizes(self, message_history, images, videos, others):
-        """Calculate total sizes for different media types."""
-        total_image_size = 0
-        total_video_size = 0
-        total_other_size = 0
-
-        for msg in message_history:
-            if msg.attachments and not msg.author.bot:
-                for attachment in msg.attachments:
-                    if str(attachment.url) in images:
-                        total_image_size += attachment.size
-                    elif str(attachment.url) in videos:
-                        total_video_size += attachment.size
-                    elif str(attachment.url) in others:
-                        total_other_size += attachment.size
-
-        return total_image_size, total_video_size, total_other_size
+        return (images, videos, others, new_urls,
+                (sizes["image"], sizes["video"], sizes["other"]), processed_count - start_counter)
 
     async def send_resume_report(self, message, images, videos, others, 
                                total_image_size, total_video_size, total_other_size, 
                                message_count, recovery_data):
         """Send report for resumed scan."""
-        colors = [0xFF0000, 0xFFEE00, 0x40FF00, 0x00BBFF, 0xFF00BB]
-        
         embed_message = discord.Embed(
             title="📊 Báo cáo quét (Đã khôi phục)", 
-            color=random.choice(colors)
+            color=random.choice(REPORT_COLORS)
         )
         
         embed_message.add_field(
@@ -761,18 +916,20 @@ class MyClient(discord.Client):
             return
 
         # Check if there's already an active scan in this channel
-        if self.active_scans.get(message.channel.id, False):
+        lock = self._get_channel_lock(message.channel.id)
+        if lock.locked():
             await message.reply("⚠️ Đã có một quét đang hoạt động trong kênh này.", delete_after=10)
             return
 
         # Check for interrupted scan
         recovery_data = self.scan_recovery.get_interrupted_scan(message.channel.id)
         if recovery_data:
+            self._discard_channel_lock(message.channel.id)
             await message.reply(f"⚠️ Có quá trình quét chưa hoàn thành. Sử dụng `{self.prefix}check_recovery` để kiểm tra hoặc `{self.prefix}resume_scan` để tiếp tục.", delete_after=15)
             return
 
-        # Mark channel as having active scan
-        self.active_scans[message.channel.id] = True
+        # Mark channel as having active scan (uncontended, so this doesn't yield)
+        await lock.acquire()
 
         try:
             # Parse command arguments
@@ -782,12 +939,17 @@ class MyClient(discord.Client):
             scan_from_last = False
             
             for part in command_parts[1:]:
-                if part.isdigit():
-                    number_of_messages = min(int(part), 500)
-                elif part == "--all":
+                match = _SCAN_ARG_RE.match(part)
+                if not match:
+                    logger.info(f"[-] Ignoring unknown scan argument: {part}")
+                    continue
+                flag, number = match.groups()
+                if flag == "all":
                     scan_all = True
-                elif part == "--new":
+                elif flag == "new":
                     scan_from_last = True
+                else:
+                    number_of_messages = min(int(number), 500)
 
             # If no specific mode and no number, default to 5 messages with new only
             if not scan_all and not scan_from_last and number_of_messages is None:
@@ -800,6 +962,7 @@ class MyClient(discord.Client):
                 'scan_all': scan_all,
             }
             
+            last_scan_time = None
             if scan_from_last:
                 last_scan_time = self.scan_history.get_last_scan_time(message.channel.id)
                 if not last_scan_time:
@@ -807,25 +970,21 @@ class MyClient(discord.Client):
                     return
                 scan_params['since_time'] = last_scan_time.isoformat()
 
-            self.scan_recovery.start_scan_session(message.channel.id, scan_type, datetime.now(), scan_params)
+            await self.scan_recovery.start_scan_session(message.channel.id, scan_type, datetime.now(), scan_params)
 
             # Continue with regular scanning process
-            await self.perform_scan(message, number_of_messages, scan_all, scan_from_last)
+            await self.perform_scan(message, number_of_messages, scan_all, scan_from_last, last_scan_time)
 
         except Exception as e:
             logger.error(f"[-] Error in scan command: {str(e)}")
             await message.channel.send(f"❌ Đã xảy ra lỗi khi quét: {str(e)}", delete_after=10)
         finally:
-            # Remove active scan flag
-            self.active_scans[message.channel.id] = False
-
-    async def perform_scan(self, message, number_of_messages, scan_all, scan_from_last):
-        """Perform the actual scanning process."""
-        # Get last scan time for time-based scanning
-        last_scan_time = None
-        if scan_from_last:
-            last_scan_time = self.scan_history.get_last_scan_time(message.channel.id)
+            # Release the scan lock
+            lock.release()
+            self._discard_channel_lock(message.channel.id)
 
+    async def perform_scan(self, message, number_of_messages, scan_all, scan_from_last, last_scan_time=None):
+        """Perform the actual scanning process (last_scan_time is required when scan_from_last)."""
         logger.info(f"[*] Scanning in {message.channel.name}, mode: all={scan_all}, from_last={scan_from_last}, limit={number_of_messages}")
 
         # Get previously scanned URLs if not scanning all
@@ -844,26 +1003,22 @@ class MyClient(discord.Client):
 
         status_msg = await message.channel.send(f"🔍 Đang quét {scan_description}...")
 
-        # Get message history based on scan mode
+        # Stream message history based on scan mode
         if scan_from_last:
-            message_history = await self.get_messages_since_time(message.channel, last_scan_time, number_of_messages)
+            message_history = self.get_messages_since_time(message.channel, last_scan_time, number_of_messages)
         else:
-            message_history = [msg async for msg in message.channel.history(limit=number_of_messages)]
+            message_history = message.channel.history(limit=number_of_messages)
 
-        if not message_history:
-            await status_msg.edit(content="📭 Không có tin nhắn mới nào để quét.", delete_after=10)
-            self.scan_recovery.complete_scan_session(message.channel.id)
-            return
-
-        # Analyze messages with recovery tracking
-        images, videos, others, new_urls = await self.analyze_messages_with_recovery(
+        # Analyze messages with recovery tracking as they are fetched
+        images, videos, others, new_urls, media_sizes, message_count = await self.analyze_messages_with_recovery(
             message_history, scanned_urls, scan_all, message.channel.id, 0
         )
+        total_image_size, total_video_size, total_other_size = media_sizes
 
-        # Calculate sizes
-        total_image_size, total_video_size, total_other_size = await self.calculate_media_sizes(
-            message_history, images, videos, others
-        )
+        if not message_count:
+            await status_msg.edit(content="📭 Không có tin nhắn mới nào để quét.", delete_after=10)
+            await self.scan_recovery.complete_scan_session(message.channel.id)
+            return
 
         # Update status message with results
         await status_msg.delete()
@@ -871,7 +1026,7 @@ class MyClient(discord.Client):
         # Send report
         await self.send_report(message, images, videos, others, 
                              total_image_size, total_video_size, total_other_size, 
-                             len(message_history), scan_all, len(scanned_urls), scan_from_last, last_scan_time)
+                             message_count, scan_all, len(scanned_urls), scan_from_last, last_scan_time)
 
         # Handle download options if media found
         if images or videos or others:
@@ -890,9 +1045,9 @@ class MyClient(discord.Client):
             await message.channel.send(no_media_msg, delete_after=10)
 
         # Mark scan as completed
-        self.scan_recovery.complete_scan_session(message.channel.id)
+        await self.scan_recovery.complete_scan_session(message.channel.id)
 
-    async def analyze_messages(self, message_history, scanned_urls: Set[str], scan_all: bool):
+    async def analyze_messages(self, message_history: AsyncIterable[discord.Message], scanned_urls: Set[int], scan_all: bool):
         """Analyze messages and categorize attachments."""
         return await self.analyze_messages_with_recovery(message_history, scanned_urls, scan_all, None, 0)
 
@@ -900,8 +1055,6 @@ class MyClient(discord.Client):
                          total_image_size, total_video_size, total_other_size, message_count, 
                          scan_all, previously_scanned, scan_from_last=False, last_scan_time=None):
         """Send scan report embed."""
-        colors = [0xFF0000, 0xFFEE00, 0x40FF00, 0x00BBFF, 0xFF00BB]
-        
         if scan_from_last:
             scan_mode = f"📊 Báo cáo quét (Từ {format_display_date(last_scan_time)})"
         elif scan_all:
@@ -909,7 +1062,7 @@ class MyClient(discord.Client):
         else:
             scan_mode = "📊 Báo cáo quét (Media mới)"
             
-        embed_message = discord.Embed(title=scan_mode, color=random.choice(colors))
+        embed_message = discord.Embed(title=scan_mode, color=random.choice(REPORT_COLORS))
         
         embed_message.add_field(
             name="📝 Tin nhắn đã quét",
@@ -962,49 +1115,31 @@ class MyClient(discord.Client):
     async def handle_download_options(self, message, images, videos, others,
                                     total_image_size, total_video_size, total_other_size):
         """Handle download options selection."""
-        emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣"]
-        options = []
-
-        if total_image_size > 0:
-            options.append("Hình ảnh")
-        if total_video_size > 0:
-            options.append("Video")
-        if total_other_size > 0:
-            options.append("Media khác")
-        if len(options) > 1:
-            options.append("Tất cả")
-
-        if not options:
+        mask = (total_image_size > 0) | ((total_video_size > 0) << 1) | ((total_other_size > 0) << 2)
+        if not mask:
             return
+        options = _DOWNLOAD_OPTIONS[mask]
 
-        # Create options message
-        options_text = "**📥 Tùy chọn tải xuống**\n"
-        for i, option in enumerate(options):
-            options_text += f"{emojis[i]} **{option}**\n"
-
-        options_message = await message.channel.send(options_text)
+        # Create options message with one button per option
+        view = DownloadView(options, message.author.id)
+        options_message = await message.channel.send("**📥 Tùy chọn tải xuống**", view=view)
 
-        # Add reactions
-        for i in range(len(options)):
-            await options_message.add_reaction(emojis[i])
+        # Wait for the command author to press a button
+        logger.info(f"[*] Waiting for download selection on message {options_message.id} from user {message.author}")
+        await view.wait()
 
-        options_emojis = [emojis[i] for i in range(len(options))]
-
-        # Wait for user reaction
-        emoji = await self.react_message(message, options_message, options_emojis)
-
-        if not emoji:
-            await options_message.edit(content="⏰ Yêu cầu tải xuống đã hết thời gian.", delete_after=10)
+        if not view.selection:
+            logger.info("[-] User didn't choose in time.")
+            await options_message.edit(content="⏰ Yêu cầu tải xuống đã hết thời gian.", view=None, delete_after=10)
             return
 
         # Process download
-        selection = options[options_emojis.index(emoji)]
-        await self.process_download(options_message, selection, images, videos, others)
+        await self.process_download(options_message, view.selection, images, videos, others)
 
     async def process_download(self, options_message, selection, images, videos, others):
         """Process the actual download."""
         try:
-            status_message = await options_message.edit(content=f"⬬ Đang tải xuống {selection}...")
+            status_message = await options_message.edit(content=f"⬬ Đang tải xuống {selection}...", view=None)
 
             # Create download folder
             server_name = options_message.guild.name if options_message.guild else "DirectMessage"
@@ -1012,28 +1147,33 @@ class MyClient(discord.Client):
             folder = create_folder(server_name=server_name, channel_name=channel_name)
 
             # Download based on selection
-            download_tasks = []
-            total_files = 0
+            download_items = []
 
             if selection == "Hình ảnh" or selection == "Tất cả":
-                for url, name in images.items():
-                    download_tasks.append(download_media(url, folder, name))
-                total_files += len(images)
+                download_items.extend(images.items())
 
             if selection == "Video" or selection == "Tất cả":
-                for url, name in videos.items():
-                    download_tasks.append(download_media(url, folder, name))
-                total_files += len(videos)
+                download_items.extend(videos.items())
 
             if selection == "Media khác" or selection == "Tất cả":
-                for url, name in others.items():
-                    download_tasks.append(download_media(url, folder, name))
-                total_files += len(others)
-
-            # Execute downloads
-            if download_tasks:
-                results = await asyncio.gather(*download_tasks, return_exceptions=True)
-                successful = sum(1 for result in results if result is True)
+                download_items.extend(others.items())
+
+            total_files = len(download_items)
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+            async def download_one(url, name):
+                async with semaphore:
+                    return await download_media(self._http, url, folder, name)
+
+            # Execute downloads, reporting progress as files finish
+            if download_items:
+                download_tasks = [asyncio.create_task(download_one(url, name)) for url, name in download_items]
+                successful = 0
+                for done, task in enumerate(asyncio.as_completed(download_tasks), start=1):
+                    if await task:
+                        successful += 1
+                    if done % DOWNLOAD_PROGRESS_INTERVAL == 0 and done < total_files:
+                        await status_message.edit(content=f"⬬ Đang tải xuống {selection}... {done}/{total_files}")
                 
                 if successful == total_files:
                     await status_message.edit(
@@ -1054,29 +1194,6 @@ class MyClient(discord.Client):
             logger.error(f"[-] Error during download: {str(e)}")
             await options_message.edit(content=f"❌ Tải xuống thất bại: {str(e)}", delete_after=10)
 
-    async def react_message(self, command_message: discord.Message, 
-                          options_message: discord.Message, options_emojis: list[str]) -> Optional[str]:
-        """Wait for user reaction and return the selected emoji."""
-        def check(reaction, user):
-            logger.debug(f"Reaction check: message_id={reaction.message.id}, "
-                        f"expected={options_message.id}, user={user}, "
-                        f"author={command_message.author}, emoji={reaction.emoji}")
-            return (
-                reaction.message.id == options_message.id
-                and user == command_message.author
-                and str(reaction.emoji) in options_emojis
-            )
-
-        logger.info(f"[*] Waiting for reaction on message {options_message.id} from user {command_message.author}")
-
-        try:
-            reaction, *_ = await self.wait_for("reaction_add", timeout=60.0, check=check)
-            logger.info(f"[+] Received valid reaction: {reaction.emoji}")
-            return str(reaction.emoji)
-        except asyncio.TimeoutError:
-            logger.info("[-] User didn't react in time.")
-            return None
-
 
 def main():
     """Main function to run the bot."""